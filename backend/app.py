@@ -1,17 +1,39 @@
-from flask import Flask, request, jsonify, send_from_directory, send_file
+from flask import Flask, request, jsonify, send_from_directory, send_file, abort
 from flask_cors import CORS
+from flask_caching import Cache
+from werkzeug.security import safe_join
+from urllib.parse import quote
 import os
-from PIL import Image, ImageOps, ImageEnhance
+import shutil
+import uuid
+import threading
+import mmap
+import xxhash
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+import multiprocessing
+import mimetypes
+import PIL
+from PIL import Image, ImageOps, features
 import numpy as np
+import numba
+import cv2
 import sys
 
 print(f"Running with Python executable: {sys.executable}")
+# Pillow-SIMD tags its releases with a ".postN" suffix
+print(f"Running with Pillow {PIL.__version__} ({'SIMD' if '.post' in PIL.__version__ else 'stock, no SIMD'})")
+# Scaled JPEG decode via draft() is only fast with libjpeg-turbo
+print(f"JPEG decoder: {'libjpeg-turbo' if features.check_feature('libjpeg_turbo') else 'libjpeg'}")
 
 app = Flask(__name__)
 CORS(app)  # Allow requests from frontend
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache'})
 
 UPLOAD_FOLDER = "uploads"
 EDITED_FOLDER = "edited_images"
+ANALYSIS_SIZE = 512  # images are analyzed at this size at most
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(EDITED_FOLDER, exist_ok=True)
 
@@ -22,14 +44,43 @@ def test():
 
 # Upload route
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # reject oversized uploads with 413 before reading them
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Behind nginx, set X_ACCEL_PREFIX (e.g. "/internal") and map it onto this
+# directory so nginx serves image files itself with sendfile(2):
+#   location /internal/ { internal; alias /path/to/backend/; }
+# Behind Apache with mod_xsendfile, set USE_X_SENDFILE=1 instead.
+X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX')
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+
+# Edited filenames carry a timestamp, so their content never changes and
+# browsers can reuse them without revalidating. Uploads can be overwritten
+# under the same name and keep Flask's default conditional (ETag/304) handling.
+EDITED_MAX_AGE = 3600
+
+def accel_redirect(folder, filename, max_age=None):
+    filepath = safe_join(folder, filename)
+    if filepath is None or not os.path.isfile(filepath):
+        abort(404)
+    response = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    response.headers['X-Accel-Redirect'] = f"{X_ACCEL_PREFIX}/{folder}/{quote(filename)}"
+    if max_age is not None:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    return response
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
+    if X_ACCEL_PREFIX:
+        return accel_redirect(app.config['UPLOAD_FOLDER'], filename)
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
 @app.route('/edited_images/<filename>')
 def edited_file(filename):
-    return send_from_directory(EDITED_FOLDER, filename)
+    if X_ACCEL_PREFIX:
+        return accel_redirect(EDITED_FOLDER, filename, max_age=EDITED_MAX_AGE)
+    return send_from_directory(EDITED_FOLDER, filename, max_age=EDITED_MAX_AGE)
 
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
@@ -40,7 +91,18 @@ def upload_file():
         return jsonify({"error": "No selected file"}), 400
     
     filepath = os.path.join(UPLOAD_FOLDER, file.filename)
-    file.save(filepath)
+    # Stream straight to disk in large chunks instead of Werkzeug's 16 KiB default.
+    # Write to a hidden temp file and rename it into place so concurrent
+    # workers uploading the same name never interleave their writes.
+    tmp_filepath = os.path.join(UPLOAD_FOLDER, f".upload-{uuid.uuid4().hex}")
+    try:
+        with open(tmp_filepath, 'wb', buffering=0) as out:
+            shutil.copyfileobj(file.stream, out, length=UPLOAD_CHUNK_SIZE)
+        os.replace(tmp_filepath, filepath)
+    except Exception:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+        raise
     return jsonify({"message": "File uploaded successfully!", "filename": file.filename})
 
 # Export route placeholder
@@ -48,13 +110,26 @@ def upload_file():
 def export_file(filename):
     filepath = os.path.join(UPLOAD_FOLDER, filename)
     if os.path.exists(filepath):
+        if X_ACCEL_PREFIX:
+            return accel_redirect(UPLOAD_FOLDER, filename)
+        # Pass the path, not a file-like object: Werkzeug hands the open file
+        # to the server's wsgi.file_wrapper, which Gunicorn serves with sendfile(2)
         return send_file(filepath)
     return jsonify({"error": "File not found"}), 404
 
+# Keyed on the folder's mtime, so any upload (which renames a file into
+# the folder) invalidates the cached listing
+@cache.memoize(timeout=60)
+def scan_images(folder, mtime_ns):
+    # scandir's is_file() uses the dirent type, no stat() per entry
+    with os.scandir(folder) as entries:
+        return [entry.name for entry in entries if not entry.name.startswith('.') and entry.is_file()]
+
 @app.route('/api/images', methods=['GET'])
 def list_images():
     try:
-        images = [f for f in os.listdir(app.config['UPLOAD_FOLDER']) if os.path.isfile(os.path.join(app.config['UPLOAD_FOLDER'], f))]
+        folder = app.config['UPLOAD_FOLDER']
+        images = scan_images(folder, os.stat(folder).st_mtime_ns)
         return jsonify(images), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -73,7 +148,53 @@ def get_new_edited_filename(filename, suffix):
     name, ext = os.path.splitext(filename)
     # Strip existing suffixes to prevent infinitely long names
     name = name.split('_')[0]
-    return f"{name}_{suffix}_{timestamp}{ext}"
+    # Batch edits save many files in the same millisecond, and stripping
+    # suffixes maps e.g. IMG_001 and IMG_002 to the same prefix
+    return f"{name}_{suffix}_{timestamp}_{uuid.uuid4().hex[:8]}{ext}"
+
+# Encoder settings by output extension: optimized Huffman tables and
+# progressive scans make libjpeg-turbo output smaller at a higher quality
+SAVE_OPTIONS = {
+    '.jpg': {'quality': 85, 'optimize': True, 'progressive': True, 'subsampling': '4:2:0'},
+    '.jpeg': {'quality': 85, 'optimize': True, 'progressive': True, 'subsampling': '4:2:0'},
+}
+
+def save_image(img, filepath):
+    ext = os.path.splitext(filepath)[1].lower()
+    img.save(filepath, **SAVE_OPTIONS.get(ext, {}))
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def apply_bcg(arr, brightness, contrast, grayscale):
+    # Brightness, contrast and grayscale applied in place to a uint8 RGB
+    # buffer, one pixel at a time with rows split across cores. Order and
+    # the 128 contrast pivot follow the CSS filter used for the frontend preview.
+    height, width, _ = arr.shape
+    for i in numba.prange(height):
+        for j in range(width):
+            r = min(arr[i, j, 0] * brightness, 255.0)
+            g = min(arr[i, j, 1] * brightness, 255.0)
+            b = min(arr[i, j, 2] * brightness, 255.0)
+            r = min(max((r - 128.0) * contrast + 128.0, 0.0), 255.0)
+            g = min(max((g - 128.0) * contrast + 128.0, 0.0), 255.0)
+            b = min(max((b - 128.0) * contrast + 128.0, 0.0), 255.0)
+            ri = np.int32(r + 0.5)
+            gi = np.int32(g + 0.5)
+            bi = np.int32(b + 0.5)
+            if grayscale:
+                # Fixed-point BT.601 luma: the weights sum to 256, so a
+                # shift replaces the float multiply-adds (within 1 LSB)
+                ri = gi = bi = (77 * ri + 150 * gi + 29 * bi + 128) >> 8
+            arr[i, j, 0] = ri
+            arr[i, j, 1] = gi
+            arr[i, j, 2] = bi
+
+# Numba's fallback "workqueue" threading layer aborts the process if two
+# threads enter a parallel kernel at once (e.g. the threaded dev server).
+# The kernel already uses every core, so serializing calls costs nothing.
+apply_bcg_lock = threading.Lock()
+
+# Compile (or load from the on-disk cache) at startup rather than on the first request
+apply_bcg(np.zeros((1, 1, 3), dtype=np.uint8), 1.0, 1.0, False)
 
 @app.route('/api/edit/apply-all', methods=['POST'])
 def apply_all_edits():
@@ -84,25 +205,71 @@ def apply_all_edits():
     if not filename:
         return jsonify({'error': 'Filename not provided'}), 400
 
+    result, status = apply_edits_to_file(filename, edits)
+    return jsonify(result), status
+
+@app.route('/api/edit/apply-all-batch', methods=['POST'])
+def apply_all_edits_batch():
+    data = request.get_json()
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    filenames = data.get('filenames')
+    edits = data.get('edits', {})
+
+    if not filenames or not isinstance(filenames, list):
+        return jsonify({'error': 'Filenames not provided'}), 400
+    if not all(isinstance(f, str) for f in filenames):
+        return jsonify({'error': 'Filenames must be strings'}), 400
+    if not isinstance(edits, dict):
+        return jsonify({'error': 'Edits must be an object'}), 400
+
+    # Fan the files out across the worker processes. A one-process pool
+    # would only add IPC and a ~170 MiB child, so edit in-process instead.
+    # Long batches are bounded by the Gunicorn timeout (gunicorn.conf.py).
+    if EDIT_POOL_WORKERS <= 1:
+        outcomes = [apply_edits_to_file(filename, edits) for filename in filenames]
+    else:
+        executor = get_edit_executor()
+        try:
+            outcomes = list(executor.map(apply_edits_to_file, filenames, repeat(edits)))
+        except BrokenProcessPool as e:
+            # A child died (e.g. OOM-killed); drop the pool so the next batch starts a fresh one
+            print(f"Batch edit pool broke: {e}")
+            reset_edit_executor(executor)
+            return jsonify({'error': 'Batch edit workers crashed, please retry'}), 500
+
+    results = []
+    for filename, (result, status) in zip(filenames, outcomes):
+        results.append({'source': filename, 'status': status, **result})
+    return jsonify({'results': results}), 200
+
+# Module level so ProcessPoolExecutor can pickle it for batch edits.
+# Returns the JSON body and status code for one file.
+def apply_edits_to_file(filename, edits):
     filepath = get_image_path(filename)
     if not filepath:
-        return jsonify({'error': 'File not found'}), 404
+        return {'error': 'File not found'}, 404
 
     try:
         img = Image.open(filepath)
         img = ImageOps.exif_transpose(img)
-        img = img.convert('RGB')
-
-        if 'brightness' in edits:
-            enhancer = ImageEnhance.Brightness(img)
-            img = enhancer.enhance(edits['brightness'])
-        
-        if 'contrast' in edits:
-            enhancer = ImageEnhance.Contrast(img)
-            img = enhancer.enhance(edits['contrast'])
-
-        if 'grayscale' in edits and edits['grayscale'] > 0:
-            img = img.convert('L').convert('RGB') # convert to grayscale and back to RGB
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        grayscale = edits.get('grayscale', 0) > 0
+        arr = np.array(img)
+        with apply_bcg_lock:
+            apply_bcg(
+                arr,
+                float(edits.get('brightness', 1.0)),
+                float(edits.get('contrast', 1.0)),
+                grayscale,
+            )
+        if grayscale:
+            # All three channels are equal; save a single-channel image
+            img = Image.fromarray(np.ascontiguousarray(arr[:, :, 0]))
+        else:
+            img = Image.fromarray(arr)
 
         # Note: Vibrancy is not a standard CSS filter, so we use Color enhancement from Pillow.
         # The frontend will need to handle this separately if it uses a vibrancy slider.
@@ -110,13 +277,98 @@ def apply_all_edits():
         new_filename = get_new_edited_filename(filename, 'edited')
         new_filepath = os.path.join(EDITED_FOLDER, new_filename)
 
-        img.save(new_filepath)
+        save_image(img, new_filepath)
 
-        return jsonify({'message': 'Edits applied successfully', 'filename': new_filename}), 200
+        return {'message': 'Edits applied successfully', 'filename': new_filename}, 200
     except Exception as e:
         print(f"Error applying edits: {e}")
-        return jsonify({'error': str(e)}), 500
-
+        return {'error': str(e)}, 500
+
+def init_edit_worker():
+    # Batch workers each take one image, so keep the Numba kernel
+    # single-threaded instead of oversubscribing every core
+    numba.set_num_threads(1)
+
+# Every child re-imports the whole app (~170 MiB each), so under Gunicorn
+# the pool gets only this worker's share of the cores (set in gunicorn.conf.py)
+EDIT_POOL_WORKERS = max(1, int(os.environ.get('EDIT_POOL_WORKERS', os.cpu_count())))
+
+edit_executor = None
+# Guards edit_executor: concurrent requests on the threaded dev server must
+# not each build (and leak) a pool, or reset a pool another request just made
+edit_executor_lock = threading.Lock()
+
+def get_edit_executor():
+    # Created on first use so each Gunicorn worker gets its own pool after
+    # forking. Spawned (not forked) children avoid inheriting the parent's
+    # Numba thread pool.
+    global edit_executor
+    with edit_executor_lock:
+        if edit_executor is None:
+            edit_executor = ProcessPoolExecutor(
+                max_workers=EDIT_POOL_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_edit_worker,
+            )
+        return edit_executor
+
+def reset_edit_executor(broken):
+    # Only drop the pool that actually broke; another request may already
+    # have replaced it with a fresh one
+    global edit_executor
+    with edit_executor_lock:
+        if edit_executor is broken:
+            edit_executor = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+REDUCED_COLOR_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+def load_analysis_image(filepath):
+    # Upright RGB array of the image, at most ANALYSIS_SIZE pixels square
+    with Image.open(filepath) as img:
+        is_jpeg = img.format == 'JPEG'
+        long_side = max(img.size) # header only, no pixel decode
+    # Analysis only needs scalar statistics: let libjpeg decode JPEGs at a
+    # reduced DCT scale, keeping twice the target. Other formats decode in
+    # full, since OpenCV would shrink them with an area-averaging resize.
+    scale = 8 if is_jpeg else 1
+    while scale > 1 and long_side / scale < ANALYSIS_SIZE * 2:
+        scale //= 2
+    arr = cv2.imread(filepath, REDUCED_COLOR_FLAGS[scale]) # applies EXIF orientation
+    is_bgr = arr is not None
+    if not is_bgr:
+        # Formats OpenCV can't decode (e.g. GIF) go through Pillow
+        img = ImageOps.exif_transpose(Image.open(filepath))
+        arr = np.asarray(img if img.mode == 'RGB' else img.convert('RGB'))
+    # Shrink the rest of the way by uniform subsampling, not averaging:
+    # averaging lowers the per-pixel spread that contrast and vibrancy measure
+    step = -(-max(arr.shape[:2]) // ANALYSIS_SIZE)
+    arr = np.ascontiguousarray(arr[::step, ::step])
+    return cv2.cvtColor(arr, cv2.COLOR_BGR2RGB) if is_bgr else arr
+
+def file_digest(filepath):
+    # xxh64 of the file contents: hashes at several GB/s straight from the
+    # page cache, negligible next to decoding the image
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return xxhash.xxh64().hexdigest() # mmap can't map an empty file
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return xxhash.xxh64(mapped).hexdigest()
+
+def histogram_stats(channel):
+    # Mean and standard deviation of an 8-bit channel from its 256-bin
+    # histogram: one pass over the pixels, the rest is a 256-entry reduction
+    hist = np.bincount(channel.ravel(), minlength=256)
+    levels = np.arange(256)
+    mean = (hist * levels).sum() / channel.size
+    std = np.sqrt((hist * (levels - mean) ** 2).sum() / channel.size)
+    return mean, std
 
 @app.route('/api/analyze/<filename>', methods=['GET'])
 def analyze_image(filename):
@@ -125,16 +377,18 @@ def analyze_image(filename):
         return jsonify({'error': 'File not found'}), 404
 
     try:
-        img = Image.open(original_filepath)
-        img = ImageOps.exif_transpose(img) # Correct orientation
-        img_gray = img.convert('L') # Convert to grayscale for analysis
+        # Analysis is deterministic given the file bytes, so reuse earlier
+        # results by content hash and skip decoding entirely on a hit
+        cache_key = f"analysis:{file_digest(original_filepath)}"
+        recommendations = cache.get(cache_key)
+        if recommendations is not None:
+            return jsonify({'filename': filename, 'recommendations': recommendations}), 200
 
-        # Convert image to numpy array for calculations
-        import numpy as np
-        img_array = np.array(img_gray)
+        rgb_array = load_analysis_image(original_filepath)
+        img_array = cv2.cvtColor(rgb_array, cv2.COLOR_RGB2GRAY) # Convert to grayscale for analysis
+        brightness, contrast = histogram_stats(img_array)
 
         # Basic Brightness Analysis (mean pixel value)
-        brightness = np.mean(img_array)
         brightness_recommendation = ""
         if brightness < 70:
             brightness_recommendation = "Image might be underexposed. Consider increasing brightness."
@@ -144,7 +398,6 @@ def analyze_image(filename):
             brightness_recommendation = "Brightness seems balanced."
 
         # Basic Contrast Analysis (standard deviation of pixel values)
-        contrast = np.std(img_array)
         contrast_recommendation = ""
         if contrast < 30:
             contrast_recommendation = "Image might lack contrast. Consider increasing contrast."
@@ -154,10 +407,11 @@ def analyze_image(filename):
             contrast_recommendation = "Contrast seems balanced."
 
         # Color Vibrancy Analysis (standard deviation of saturation channel)
-        img_hsv = img.convert('HSV')
-        hsv_array = np.array(img_hsv)
-        saturation = hsv_array[:,:,1] # Saturation channel
-        vibrancy = np.std(saturation)
+        # HSV saturation, (max - min) * 255 / max, straight from the RGB channels
+        max_c = rgb_array.max(axis=2)
+        min_c = rgb_array.min(axis=2)
+        saturation = ((max_c - min_c).astype(np.uint16) * 255 // np.maximum(max_c, 1)).astype(np.uint8)
+        _, vibrancy = histogram_stats(saturation)
         vibrancy_recommendation = ""
         if vibrancy < 50:
             vibrancy_recommendation = "Image might lack color vibrancy. Consider increasing saturation."
@@ -171,10 +425,12 @@ def analyze_image(filename):
         if contrast_recommendation: recommendations.append(contrast_recommendation)
         if vibrancy_recommendation: recommendations.append(vibrancy_recommendation)
 
+        cache.set(cache_key, recommendations, timeout=3600)
         return jsonify({'filename': filename, 'recommendations': recommendations}), 200
     except Exception as e:
         print(f"Error during image analysis: {e}") # Print the actual error
         return jsonify({'error': str(e)}), 500
 
+# Development server only; in production run under Gunicorn (see gunicorn.conf.py)
 if __name__ == '__main__':
     app.run(debug=True)
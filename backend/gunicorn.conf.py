@@ -0,0 +1,30 @@
+# Production server: gunicorn -c gunicorn.conf.py app:app (from backend/)
+import multiprocessing
+import os
+
+bind = "0.0.0.0:5000"
+
+# A few sync workers (one request each), with the cores split between them
+# below. Each worker's share goes to its Numba edit kernel threads and to
+# its batch edit process pool, so a batch spreads over cpu_count() // workers
+# cores while the machine runs about cpu_count() threads and pool children
+# in total. Override the worker count with WEB_CONCURRENCY.
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "sync"
+
+# Sync workers are killed after this many seconds, and /api/edit/apply-all-batch
+# runs a whole batch within one request. A 24 MP JPEG takes about 2.5 s on
+# one core (mostly decode and encode), so 600 s covers roughly 240 such
+# photos per pool process; larger batches should be split by the client.
+timeout = 600
+
+# Runs in each worker before it imports the app, using the effective worker
+# count so a -w override is respected. Values already in the environment win.
+def post_fork(server, worker):
+    share = max(1, multiprocessing.cpu_count() // server.cfg.workers)
+    os.environ.setdefault("NUMBA_NUM_THREADS", str(share))
+    os.environ.setdefault("EDIT_POOL_WORKERS", str(share))
+
+# Serve send_file() responses with sendfile(2) so file bytes never pass
+# through the Python heap
+sendfile = True